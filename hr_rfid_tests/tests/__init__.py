@@ -1,4 +1,5 @@
 from . import common
+from . import test_benchmark
 from . import test_hr_department
 from . import test_hr_employee
 from . import test_hr_rfid_access_group
@@ -1,8 +1,12 @@
 from odoo.api import Environment
 from odoo import models
-from random import randint
+from random import sample
+from contextlib import contextmanager
+
+import time
 
 _controllers_created = 0
+_ctrl_ids = [ a for a in range(1, 255) if a != 0xCB and a != 0xCE ]
 
 
 def create_webstacks(env: Environment, webstacks: int = 0, controllers: list = None):
@@ -18,111 +22,81 @@ def create_webstacks(env: Environment, webstacks: int = 0, controllers: list = N
     if controllers is None:
         controllers = []
 
-    def _create_wss():
-        _records = env['hr.rfid.webstack']
-        _ws_env = env['hr.rfid.webstack']
-
-        def gen_serial(cur_webstacks):
-            _cur_serials = cur_webstacks.mapped('serial')
-
-            while True:
-                _serial = str(randint(400000, 499999))
-                if _serial not in _cur_serials:
-                    return _serial
-
-        for i in range(webstacks):
-            serial = gen_serial(_records)
-
-            _records += _ws_env.create({
-                'name': 'Module ' + serial,
-                'serial': serial,
-                'key': '0000',
-                'ws_active': True,
-                'version': '9.99',
-                'behind_nat': False,
-                'last_ip': '0.0.0.0',
-            })
-        return _records
-
-    def _create_ctrl(_ws: models.Model, _mode: int):
-        _ctrl_env = env['hr.rfid.ctrl']
-        _door_env = env['hr.rfid.door']
-        _reader_env = env['hr.rfid.reader']
-
-        def _gen_id():
-            _cur_ids = _ws.controllers.mapped('ctrl_id')
-            while True:
-                _new_id = randint(1, 254)
-                if _new_id == 0xCB or _new_id == 0xCE:
-                    continue
-                if _new_id not in _cur_ids:
-                    return _new_id
-
-        def _gen_door_name(_door_num, _ctrl_id):
-            return 'Door ' + str(_door_num) + ' of ctrl ' + str(_ctrl_id)
-
-        def _create_door(_name, _number, _ctrl_id):
-            return _door_env.create({
-                'name': _name,
-                'number': _number,
-                'controller_id': _ctrl_id,
-            })
+    global _controllers_created
 
-        def _create_reader(_name, _number, _reader_type, _ctrl_id, _door_id):
-            _reader_env.create({
-                'name': _name,
-                'number': _number,
-                'reader_type': _reader_type,
-                'controller_id': _ctrl_id,
-                'door_id': _door_id,
-            })
+    serials = [ str(a) for a in sample(range(400000, 500000), webstacks) ]
+    records = env['hr.rfid.webstack'].create([{
+        'name': 'Module ' + serial,
+        'serial': serial,
+        'key': '0000',
+        'ws_active': True,
+        'version': '9.99',
+        'behind_nat': False,
+        'last_ip': '0.0.0.0',
+    } for serial in serials])
+
+    if not controllers:
+        return records
 
-        _external_db = _mode & 0x20 > 0
-        _mode = _mode & 0x0F
-        _id = _gen_id()
-
-        global _controllers_created
-        _controllers_created += 1
-        _ctrl = _ctrl_env.create({
-            'name': 'Controller ' + str(_id),
-            'ctrl_id': _id,
-            'hw_version': '17',
-            'serial_number': _controllers_created,
-            'sw_version': '999',
-            'external_db': _external_db,
-            'mode': _mode,
-            'webstack_id': _ws.id,
-        })
-
-        if _mode == 1 or _mode == 3:
-            _door = _create_door(_gen_door_name(1, _ctrl.id), 1, _ctrl.id)
-            _create_reader('R1', 1, '0', _ctrl.id, _door.id)
-            _create_reader('R2', 2, '1', _ctrl.id, _door.id)
-        else:  # (_mode == 2 and readers_count == 2) or _mode == 4
-            _door = _create_door(_gen_door_name(1, _ctrl.id), 1, _ctrl.id)
-            _create_reader('R1', 1, '0', _ctrl.id, _door.id)
-            _door = _create_door(_gen_door_name(2, _ctrl.id), 2, _ctrl.id)
-            _create_reader('R2', 2, '0', _ctrl.id, _door.id)
-
-        if _mode == 3:
-            _door = _create_door(_gen_door_name(2, _ctrl.id), 2, _ctrl.id)
-            _create_reader('R3', 3, '0', _ctrl.id, _door.id)
-            _door = _create_door(_gen_door_name(3, _ctrl.id), 3, _ctrl.id)
-            _create_reader('R4', 4, '0', _ctrl.id, _door.id)
-        elif _mode == 4:
-            _door = _create_door(_gen_door_name(3, _ctrl.id), 3, _ctrl.id)
-            _create_reader('R3', 3, '0', _ctrl.id, _door.id)
-            _door = _create_door(_gen_door_name(4, _ctrl.id), 4, _ctrl.id)
-            _create_reader('R4', 4, '0', _ctrl.id, _door.id)
-
-    records = _create_wss()
+    ctrl_vals = []
+    ctrl_modes = []
     for ws in records:
-        for mode in controllers:
-            _create_ctrl(ws, mode)
+        for _id, _mode in zip(sample(_ctrl_ids, len(controllers)), controllers):
+            _controllers_created += 1
+            ctrl_vals.append({
+                'name': 'Controller ' + str(_id),
+                'ctrl_id': _id,
+                'hw_version': '17',
+                'serial_number': _controllers_created,
+                'sw_version': '999',
+                'external_db': _mode & 0x20 > 0,
+                'mode': _mode & 0x0F,
+                'webstack_id': ws.id,
+            })
+            ctrl_modes.append(_mode & 0x0F)
+    ctrls = env['hr.rfid.ctrl'].create(ctrl_vals)
+
+    door_vals = []
+    door_readers = []
+    for ctrl, mode in zip(ctrls, ctrl_modes):
+        for door_number, readers in _ctrl_layout(mode):
+            door_vals.append({
+                'name': 'Door ' + str(door_number) + ' of ctrl ' + str(ctrl.id),
+                'number': door_number,
+                'controller_id': ctrl.id,
+            })
+            door_readers.append((ctrl.id, readers))
+    doors = env['hr.rfid.door'].create(door_vals)
+
+    env['hr.rfid.reader'].create([{
+        'name': name,
+        'number': number,
+        'reader_type': reader_type,
+        'controller_id': ctrl_id,
+        'door_id': door.id,
+    } for door, (ctrl_id, readers) in zip(doors, door_readers) for name, number, reader_type in readers])
 
     return records
 
 
+def _ctrl_layout(mode: int):
+    """
+    Doors and readers of a controller in a given mode
+    :return: List of (door_number, [(reader_name, reader_number, reader_type), ...])
+    """
+    if mode == 1 or mode == 3:
+        layout = [ (1, [ ('R1', 1, '0'), ('R2', 2, '1') ]) ]
+    else:  # (mode == 2 and readers_count == 2) or mode == 4
+        layout = [ (1, [ ('R1', 1, '0') ]), (2, [ ('R2', 2, '0') ]) ]
+
+    if mode == 3:
+        layout += [ (2, [ ('R3', 3, '0') ]), (3, [ ('R4', 4, '0') ]) ]
+    elif mode == 4:
+        layout += [ (3, [ ('R3', 3, '0') ]), (4, [ ('R4', 4, '0') ]) ]
+
+    return layout
+
+
 def create_acc_grs_nms(env: Environment, names: list = None):
     """
     Create access groups
@@ -130,18 +104,10 @@ def create_acc_grs_nms(env: Environment, names: list = None):
     :param names: Names of access groups in a list
     :return: Set with the access groups
     """
-    records = env['hr.rfid.access.group']
-    acc_gr_env = records
-
     if names is None:
-        return records
-
-    for name in names:
-        records += acc_gr_env.create({
-            'name': name,
-        })
+        return env['hr.rfid.access.group']
 
-    return records
+    return env['hr.rfid.access.group'].create([ { 'name': name } for name in names ])
 
 
 def create_acc_grs_cnt(env: Environment, count: int = 0):
@@ -151,70 +117,43 @@ def create_acc_grs_cnt(env: Environment, count: int = 0):
     :param count: Number of access groups to create
     :return: Set with the access groups
     """
-    records = env['hr.rfid.access.group']
-    acc_gr_env = records
-
-    for __ in range(0, count):
-        records += acc_gr_env.create({})
-
-    return records
+    return env['hr.rfid.access.group'].create([ {} for __ in range(count) ])
 
 
 def create_departments(env: Environment, names: list = None):
-    records = env['hr.department']
-    dep_env = records
-
     if names is None:
-        return records
+        return env['hr.department']
 
-    for name in names:
-        records += dep_env.create({
-            'name': name,
-        })
-
-    return records
+    return env['hr.department'].create([ { 'name': name } for name in names ])
 
 
 def create_employees(env: Environment, names: list = None, departments: list = None):
-    records = env['hr.employee']
-    emp_env = records
-
     if names is None:
-        return records
+        return env['hr.employee']
     if departments is None:
         departments = []
 
-    dep_it = 0
-
-    for name in names:
+    vals_list = []
+    for i, name in enumerate(names):
         emp_dict = {
             'name': name,
         }
-        if dep_it < len(departments):
-            emp_dict['department_id'] = departments[dep_it].id
-            dep_it += 1
-        records += emp_env.create(emp_dict)
+        if i < len(departments):
+            emp_dict['department_id'] = departments[i].id
+        vals_list.append(emp_dict)
 
-    return records
+    return env['hr.employee'].create(vals_list)
 
 
 def create_contacts(env: Environment, names: list = None):
-    records = env['res.partner']
-    contact_env = records
-
     if names is None:
-        return records
+        return env['res.partner']
 
-    for name in names:
-        records += contact_env.create({
-            'name': name,
-        })
-
-    return records
+    return env['res.partner'].create([ { 'name': name } for name in names ])
 
 
-def create_card(env: Environment, number: str, owner: models.Model, card_type=None, activate_on=None,
-                deactivate_on=None, card_active=None, cloud_card=None):
+def _card_vals(number: str, owner: models.Model, card_type=None, activate_on=None, deactivate_on=None,
+               card_active=None, cloud_card=None):
     card_dict = {
         'number': number,
     }
@@ -238,9 +177,40 @@ def create_card(env: Environment, number: str, owner: models.Model, card_type=No
     if cloud_card is not None:
         card_dict['cloud_card'] = cloud_card
 
+    return card_dict
+
+
+def create_card(env: Environment, number: str, owner: models.Model, card_type=None, activate_on=None,
+                deactivate_on=None, card_active=None, cloud_card=None):
+    card_dict = _card_vals(number, owner, card_type, activate_on, deactivate_on, card_active, cloud_card)
     return env['hr.rfid.card'].create(card_dict)
 
 
+def create_cards(env: Environment, numbers: list, owners: list, **kwargs):
+    """
+    Create cards with a single create call
+    :param env: Environment
+    :param numbers: Card numbers
+    :param owners: Owner of each card, same length as numbers
+    :param kwargs: Same optional fields as create_card, applied to every card
+    :return: Recordset with the cards, in the order of numbers
+    """
+    return env['hr.rfid.card'].create([
+        _card_vals(number, owner, **kwargs) for number, owner in zip(numbers, owners)
+    ])
+
+
+def create_unique_cards(env: Environment, owners: list = None):
+    """
+    Create one card with a random unique number for every owner
+    """
+    if owners is None:
+        return env['hr.rfid.card']
+
+    numbers = [ '%010d' % a for a in sample(range(10 ** 10), len(owners)) ]
+    return create_cards(env, numbers, owners)
+
+
 def card_door_rels_search(env: Environment, card: models.Model, door: models.Model, ts: models.Model = None):
     rel_env = env['hr.rfid.card.door.rel']
     search_params = [
@@ -254,3 +224,108 @@ def card_door_rels_search(env: Environment, card: models.Model, door: models.Mod
 
 def get_ws_doors(webstacks):
     return webstacks.mapped('controllers').mapped('door_ids')
+
+
+def io_table_from_rows(io_rows):
+    """
+    Encode the rows of an IO table (e.g. hr.rfid.ctrl.io.table.wiz io_row_ids) the way
+    hr.rfid.ctrl.io_table stores them: out8 to out1 of every row as two hex digits
+    """
+    outs = bytes(out for row in io_rows
+                 for out in (row.out8, row.out7, row.out6, row.out5, row.out4, row.out3, row.out2, row.out1))
+    return outs.hex().upper()
+
+
+class OperationStats(object):
+    """
+    Counters collected by profile_operation:
+    - operation: Name of the profiled operation
+    - queries: SQL queries run by the operation, without the profiler's own
+    - rels_created: Net card/door relation rows added
+    - rels_deleted: Net card/door relation rows removed
+    - commands: Net command rows added
+    - elapsed: Wall time in seconds
+    """
+
+    def __init__(self, operation: str = None):
+        self.operation = operation
+        self.queries = 0
+        self.rels_created = 0
+        self.rels_deleted = 0
+        self.commands = 0
+        self.elapsed = 0.0
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def _table_state(env: Environment, model: str):
+    env.cr.execute('SELECT COALESCE(MAX(id), 0), COUNT(*) FROM ' + env[model]._table)
+    return env.cr.fetchone()
+
+
+@contextmanager
+def profile_operation(env: Environment, operation: str = None, results: list = None):
+    """
+    Profile the code run inside the with block. The queries used for the bookkeeping are not
+    counted. Relations and commands are counted by the rows left in their tables, so a relation
+    created and removed inside the block is not counted and neither is a command updated in place.
+    :param env: Environment
+    :param operation: Name of the operation, kept in the stats
+    :param results: If given the stats are appended to it after the block finishes
+    :return: OperationStats, filled in after the block finishes
+    """
+    stats = OperationStats(operation)
+    rel_table = env['hr.rfid.card.door.rel']._table
+    cmd_table = env['hr.rfid.command']._table
+    rel_max_id, rel_count = _table_state(env, 'hr.rfid.card.door.rel')
+    cmd_max_id, __ = _table_state(env, 'hr.rfid.command')
+
+    queries_before = env.cr.sql_log_count
+    start = time.perf_counter()
+    yield stats
+    stats.elapsed = time.perf_counter() - start
+    stats.queries = env.cr.sql_log_count - queries_before
+
+    env.cr.execute('SELECT COUNT(*) FILTER (WHERE id > %s), COUNT(*) FROM ' + rel_table, (rel_max_id,))
+    rels_new, rels_count_after = env.cr.fetchone()
+    stats.rels_created = rels_new
+    stats.rels_deleted = rel_count + rels_new - rels_count_after
+
+    env.cr.execute('SELECT COUNT(*) FROM ' + cmd_table + ' WHERE id > %s', (cmd_max_id,))
+    stats.commands = env.cr.fetchone()[0]
+
+    if results is not None:
+        results.append(stats)
+
+
+class ProfilingMixin(object):
+    """
+    Performance budget assertions for test cases, built on profile_operation
+    """
+
+    @contextmanager
+    def assertOperationBudget(self, queries: int = None, commands: int = None, rels_created: int = None,
+                              rels_deleted: int = None, elapsed: float = None):
+        """
+        Fail if the code inside the with block goes over any of the given limits
+        """
+        with profile_operation(self.env) as stats:
+            yield stats
+
+        budget = [
+            ('queries', queries),
+            ('commands', commands),
+            ('rels_created', rels_created),
+            ('rels_deleted', rels_deleted),
+            ('elapsed', elapsed),
+        ]
+        for counter, limit in budget:
+            if limit is not None:
+                self.assertLessEqual(getattr(stats, counter), limit,
+                                     msg='Operation went over its %s budget' % counter)
+
+    @contextmanager
+    def assertQueryCountLE(self, max_queries: int):
+        with self.assertOperationBudget(queries=max_queries) as stats:
+            yield stats
@@ -0,0 +1,228 @@
+"""
+Benchmarks for the card/door relation engine on a generated site.
+
+The benchmarks are not part of the standard test run, start them with
+``--test-tags hr_rfid_benchmark``. BenchmarkHarnessTests does run with the standard tests and checks
+the harness on a tiny site.
+
+The site is configured with environment variables, e.g. for 50 webstacks with 4 mode 3 controllers
+each, 20000 cards and 200 access groups:
+
+    HR_RFID_BENCH_WEBSTACKS=50 HR_RFID_BENCH_CONTROLLERS=3,3,3,3 HR_RFID_BENCH_CARDS=20000 \\
+    HR_RFID_BENCH_ACCESS_GROUPS=200 HR_RFID_BENCH_OUTPUT=bench.json \\
+    odoo-bin -d bench -i hr_rfid_tests --test-tags hr_rfid_benchmark --stop-after-init
+
+Every measured operation is profiled with common.profile_operation: wall time, SQL queries,
+card/door relations created and deleted and commands produced. The results are written as JSON to
+HR_RFID_BENCH_OUTPUT, or logged if it is not set.
+"""
+from odoo import release
+from odoo.tests import common, tagged
+from .common import create_webstacks, create_acc_grs_cnt, create_employees, create_cards, get_ws_doors, \
+    profile_operation
+
+import datetime
+import json
+import logging
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+_logger = logging.getLogger(__name__)
+
+
+def _bench_params():
+    params = {
+        'webstacks': int(os.environ.get('HR_RFID_BENCH_WEBSTACKS', 2)),
+        'controllers': [ int(a) for a in os.environ.get('HR_RFID_BENCH_CONTROLLERS', '3,3').split(',') ],
+        'cards': int(os.environ.get('HR_RFID_BENCH_CARDS', 200)),
+        'access_groups': int(os.environ.get('HR_RFID_BENCH_ACCESS_GROUPS', 10)),
+    }
+    if params['access_groups'] < 1:
+        raise ValueError('HR_RFID_BENCH_ACCESS_GROUPS must be at least 1, got %d' % params['access_groups'])
+    return params
+
+
+def _chunks(records, count: int):
+    """
+    Split a recordset in count parts of (almost) equal size
+    """
+    return [ records[i::count] for i in range(count) ]
+
+
+def _build_site(env, params: dict):
+    """
+    Create the benchmark site: webstacks, access groups and employees with one card each. The
+    employees and doors are split evenly between the access groups
+    :param params: As returned by _bench_params
+    :return: dict with the created records and the setup time in seconds
+    """
+    setup_start = time.perf_counter()
+
+    webstacks = create_webstacks(env, params['webstacks'], params['controllers'])
+    doors = get_ws_doors(webstacks)
+    acc_grs = create_acc_grs_cnt(env, params['access_groups'])
+    def_ts = env.ref('hr_rfid.hr_rfid_time_schedule_0')
+
+    employees = create_employees(env, [ 'Employee %d' % i for i in range(params['cards']) ])
+    cards = create_cards(env, [ '%010d' % (i + 1) for i in range(len(employees)) ], employees)
+
+    for acc_gr, chunk in zip(acc_grs, _chunks(employees, len(acc_grs))):
+        for emp in chunk:
+            emp.add_acc_gr(acc_gr)
+
+    for acc_gr, chunk in zip(acc_grs, _chunks(doors, len(acc_grs))):
+        acc_gr.add_doors(chunk, def_ts)
+
+    return {
+        'webstacks': webstacks,
+        'doors': doors,
+        'acc_grs': acc_grs,
+        'def_ts': def_ts,
+        'employees': employees,
+        'cards': cards,
+        'setup_time': time.perf_counter() - setup_start,
+    }
+
+
+def _write_report(params: dict, site: dict, results: list):
+    """
+    Write the results as JSON to HR_RFID_BENCH_OUTPUT, or log them if it is not set
+    :param site: As returned by _build_site
+    :param results: OperationStats of the measured operations
+    """
+    report = {
+        'date': datetime.datetime.utcnow().isoformat(),
+        'odoo_version': release.version,
+        'params': params,
+        'site': {
+            'doors': len(site['doors']),
+            'setup_time': site['setup_time'],
+        },
+        'results': [ a.to_dict() for a in results ],
+    }
+    report = json.dumps(report, indent=4)
+
+    output = os.environ.get('HR_RFID_BENCH_OUTPUT')
+    if output:
+        with open(output, 'w') as f:
+            f.write(report)
+    else:
+        _logger.info('Relation engine benchmark results:\n%s', report)
+
+
+class BenchmarkHarnessTests(common.SavepointCase):
+    """
+    Runs with the standard tests so the benchmark harness doesn't rot between benchmark runs
+    """
+
+    def test_bench_params_no_access_groups(self):
+        with patch.dict(os.environ, { 'HR_RFID_BENCH_ACCESS_GROUPS': '0' }):
+            with self.assertRaises(ValueError):
+                _bench_params()
+
+    def test_smoke_run(self):
+        env_params = {
+            'HR_RFID_BENCH_WEBSTACKS': '1',
+            'HR_RFID_BENCH_CONTROLLERS': '2',
+            'HR_RFID_BENCH_CARDS': '3',
+            'HR_RFID_BENCH_ACCESS_GROUPS': '1',
+        }
+        with patch.dict(os.environ, env_params):
+            params = _bench_params()
+        site = _build_site(self.env, params)
+        self.assertEqual(len(site['cards']), 3)
+        self.assertTrue(site['doors'])
+
+        rel_env = self.env['hr.rfid.card.door.rel']
+        rel_env.search([]).unlink()
+        results = []
+        with profile_operation(self.env, 'update_door_rels', results):
+            for door in site['doors']:
+                rel_env.update_door_rels(door)
+        self.assertEqual(results[0].rels_created, len(site['cards']) * len(site['doors']))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'bench.json')
+            with patch.dict(os.environ, { 'HR_RFID_BENCH_OUTPUT': output }):
+                _write_report(params, site, results)
+            with open(output) as f:
+                report = json.load(f)
+
+        self.assertEqual(set(report), { 'date', 'odoo_version', 'params', 'site', 'results' })
+        self.assertEqual(report['odoo_version'], release.version)
+        self.assertEqual(report['params'], params)
+        self.assertEqual(report['site'], { 'doors': len(site['doors']), 'setup_time': site['setup_time'] })
+        self.assertEqual(len(report['results']), 1)
+        result = report['results'][0]
+        self.assertEqual(set(result), { 'operation', 'queries', 'rels_created', 'rels_deleted',
+                                        'commands', 'elapsed' })
+        self.assertEqual(result['operation'], 'update_door_rels')
+        self.assertEqual(result['rels_created'], len(site['cards']) * len(site['doors']))
+
+
+@tagged('-standard', 'hr_rfid_benchmark')
+class RelEngineBenchmark(common.SavepointCase):
+    @classmethod
+    def setUpClass(cls):
+        super(RelEngineBenchmark, cls).setUpClass()
+        cls._params = _bench_params()
+        cls._results = []
+        cls._site = _build_site(cls.env, cls._params)
+
+        cls._ws = cls._site['webstacks']
+        cls._doors = cls._site['doors']
+        cls._acc_grs = cls._site['acc_grs']
+        cls._def_ts = cls._site['def_ts']
+        cls._employees = cls._site['employees']
+        cls._cards = cls._site['cards']
+
+    @classmethod
+    def tearDownClass(cls):
+        _write_report(cls._params, cls._site, cls._results)
+        super(RelEngineBenchmark, cls).tearDownClass()
+
+    def measure(self, operation: str, fn):
+        with profile_operation(self.env, operation, self._results):
+            fn()
+
+    def test_add_doors(self):
+        acc_gr = create_acc_grs_cnt(self.env, 1)
+        for emp in self._employees:
+            emp.add_acc_gr(acc_gr)
+
+        self.measure('add_doors', lambda: acc_gr.add_doors(self._doors, self._def_ts))
+
+    def test_add_acc_gr(self):
+        acc_gr = self._acc_grs[0]
+        employees = self._employees.filtered(
+            lambda e: acc_gr not in e.hr_rfid_access_group_ids.mapped('access_group_id')
+        )
+
+        def _add_acc_gr():
+            for emp in employees:
+                emp.add_acc_gr(acc_gr)
+
+        self.measure('add_acc_gr', _add_acc_gr)
+
+    def test_button_reload_cards(self):
+        def _reload():
+            for ctrl in self._ws.mapped('controllers'):
+                ctrl.button_reload_cards()
+
+        self.measure('button_reload_cards', _reload)
+
+    def test_update_door_rels(self):
+        rel_env = self.env['hr.rfid.card.door.rel']
+        rel_env.search([]).unlink()
+
+        def _update():
+            for door in self._doors:
+                rel_env.update_door_rels(door)
+
+        self.measure('update_door_rels', _update)
+
+    def test_write_cards(self):
+        self.measure('write_card_active_false', lambda: self._cards.write({ 'card_active': False }))
+        self.measure('write_card_active_true', lambda: self._cards.write({ 'card_active': True }))
@@ -1,10 +1,15 @@
 from odoo.tests import common
 from odoo import exceptions
 from .common import create_webstacks, create_acc_grs_cnt, create_contacts, create_card, \
-    get_ws_doors, create_departments, create_employees
+    create_unique_cards, get_ws_doors, create_departments, create_employees, profile_operation, \
+    ProfilingMixin
 
 
-class AccessGroupTests(common.SavepointCase):
+class AccessGroupTests(ProfilingMixin, common.SavepointCase):
+    # Extra queries add_doors may spend for every extra card in the group. Creating the relation and
+    # the command of a card costs a few queries, anything that re-reads the group per card is over it
+    _add_doors_queries_per_card = 10
+
     @classmethod
     def setUpClass(cls):
         super(AccessGroupTests, cls).setUpClass()
@@ -87,7 +92,9 @@ class AccessGroupTests(common.SavepointCase):
 
         cards = self._contacts.mapped('hr_rfid_card_ids')
 
-        acc_gr.add_doors(door)
+        with self.assertOperationBudget(commands=len(cards), rels_deleted=0) as stats:
+            acc_gr.add_doors(door)
+        self.assertEqual(stats.rels_created, len(cards))
         rels = self.env['hr.rfid.card.door.rel']
         for card in cards:
             rel = self.find_card_door_rel(card, door)
@@ -107,11 +114,57 @@ class AccessGroupTests(common.SavepointCase):
         with self.assertRaises(exceptions.ValidationError):
             acc_gr.add_doors(door, self._other_ts)
 
-        acc_gr.del_doors(door)
+        with self.assertOperationBudget(commands=len(cards), rels_created=0) as stats:
+            acc_gr.del_doors(door)
+        self.assertEqual(stats.rels_deleted, len(cards))
         new_rels = rel_env.search([])
         self.assertFalse(rels.exists())
         self.assertFalse(new_rels.exists())
 
+    def acc_gr_with_cards(self, count: int):
+        """
+        Create an access group with count new contacts in it, each with one card
+        """
+        acc_gr = create_acc_grs_cnt(self.env, 1)
+        contacts = create_contacts(self.env, [ 'Contact %d' % i for i in range(count) ])
+        create_unique_cards(self.env, contacts)
+        for contact in contacts:
+            contact.add_acc_gr(acc_gr)
+        return acc_gr
+
+    def test_add_doors_query_scaling(self):
+        door = self._doors[1]
+        cards_count = 5
+
+        acc_gr = self.acc_gr_with_cards(cards_count)
+        with profile_operation(self.env) as baseline:
+            acc_gr.add_doors(door, self._def_ts)
+        self.assertEqual(baseline.rels_created, cards_count)
+
+        # Twice the cards may cost at most the per card allowance more than the measured baseline
+        acc_gr = self.acc_gr_with_cards(2 * cards_count)
+        budget = baseline.queries + self._add_doors_queries_per_card * cards_count
+        with self.assertOperationBudget(queries=budget, commands=2 * cards_count) as stats:
+            acc_gr.add_doors(door, self._def_ts)
+        self.assertEqual(stats.rels_created, 2 * cards_count)
+
+    def test_operation_budget(self):
+        acc_gr = create_acc_grs_cnt(self.env, 1)
+        door = self._doors[1]
+
+        # The profiler's own bookkeeping queries are not counted
+        with self.assertQueryCountLE(0):
+            pass
+
+        with self.assertRaises(AssertionError):
+            with self.assertQueryCountLE(0):
+                acc_gr.write({ 'name': 'Budget' })
+
+        self._contacts[0].add_acc_gr(acc_gr)
+        with self.assertRaises(AssertionError):
+            with self.assertOperationBudget(rels_created=0):
+                acc_gr.add_doors(door, self._def_ts)
+
     def test_inheritance_fields(self):
         # Picture:
         #      A0   A1
@@ -1,32 +1,10 @@
-from odoo import api, exceptions
+from odoo import exceptions
 from odoo.tests import common
 from .common import create_webstacks, create_acc_grs_cnt, create_employees, create_contacts, create_card, \
-    create_departments, card_door_rels_search, get_ws_doors
-from random import randint
+    create_departments, card_door_rels_search, get_ws_doors, create_unique_cards
 from psycopg2 import IntegrityError
 
 
-def create_unique_cards(env: api.Environment, owners: list = None):
-    cards = env['hr.rfid.card']
-
-    if owners is None:
-        return cards
-
-    current_numbers = []
-
-    for owner in owners:
-        while True:
-            new_number = ''
-            for __ in range(10):
-                new_number += str(randint(0, 9))
-            if new_number not in current_numbers:
-                current_numbers.append(new_number)
-                break
-        cards += create_card(env, new_number, owner)
-
-    return cards
-
-
 class CardTests(common.SavepointCase):
     @classmethod
     def setUpClass(cls):
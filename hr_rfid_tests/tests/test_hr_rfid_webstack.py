@@ -1,191 +1,18 @@
 from odoo.tests import common
 from odoo import exceptions, fields
 from .common import create_webstacks, create_acc_grs_cnt, create_contacts, create_card, \
-    get_ws_doors, create_employees, create_departments
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from threading import Thread
+    get_ws_doors, create_employees, create_departments, io_table_from_rows
+from .webstack_emulator import WebstackEmulationHandler, VirtualWebstack, \
+    WebstackEmulatorFleet, start_server, start_emulator, stop_emulator
+from http.server import BaseHTTPRequestHandler
+from http.client import HTTPConnection
 from queue import Queue
 from functools import partial
 
+import datetime
 import json
-
-
-class WebstackEmulationHandler(BaseHTTPRequestHandler):
-    def __init__(self, queue: Queue, *args, **kwargs):
-        self._q = queue
-        super().__init__(*args, **kwargs)
-
-    def do_GET(self):
-        body = {
-            'bridgeClient': {
-                'add_info': 0,
-                'auto_connect': 0,
-                'last_error': 0,
-                'port': 5000,
-                'status': 0,
-                'url': 'url.or.ip.com'
-            },
-            'convertor': 404040,
-            'currentIPFiltering': {
-                'IP1': '0.0.0.0',
-                'checkbox_Enable_IP1_filter': ''
-            },
-            'inputOutputHardware': {
-                'portInDigital': 5,
-                'portOut': 4,
-                'uarts': [
-                    [
-                        0,
-                        [
-                            0,
-                            2,
-                            5
-                        ]
-                    ],
-                    [
-                        2,
-                        [
-                            0,
-                            1,
-                            2,
-                            5
-                        ]
-                    ]
-                ]
-            },
-            'netConfig': {
-                'Gateway': '192.168.74.254',
-                'Host_Name': 'WIFI-16C4',
-                'IP_Address': '192.168.74.61',
-                'MAC_Address': '24:0a:c4:16:04:c3',
-                'Primary_DNS': '192.168.74.254',
-                'Secondary_DNS': '0.0.0.0',
-                'Subnet_Mask': '255.255.255.0',
-                'checkbox_DHCP': 'checked',
-                'net_mode': 1,
-                'sntp_server': 'bg.pool.ntp.org'
-            },
-            'sdk': {
-                'ConnectionType': 3,
-                'TCPStackVersion': 'v3.3-71-g46b12a5',
-                'devFound': 1,
-                'deviceTime': 1571388442,
-                'freeRAM': 69716,
-                'heartBeatCounter': 2375,
-                'heartBeatTimeOut': 11,
-                'isBridgeActive': 0,
-                'isCmdExecute': 0,
-                'isCmdWaiting': 0,
-                'isDeviceScan': 0,
-                'isEventPause': 0,
-                'isEventScan': 1,
-                'isServerToSendDown': 0,
-                'maxDevInList': 64,
-                'remoteIP': '0.0.0.0',
-                'scanIDfrom': 0,
-                'scanIDprogress': 0,
-                'scanIDto': 254,
-                'sdkHardware': '100.1',
-                'sdkVersion': '1.46',
-                'upTime': '1d 15:51:08'
-            },
-            'sdkSettings': {
-                'Bridge_PORT': 5000,
-                'HeartBeat_Time': 60,
-                'Server_PORT': '8069',
-                'Server_URL': 'ilian.com/hr/rfid/event',
-                'checkbox_Enable_HTTP_IO_Event_Server_Push': '',
-                'checkbox_Enable_HTTP_Pull_Technology': 'checked',
-                'checkbox_Enable_HTTP_Server_Push': 'checked',
-                'checkbox_Enable_HeartBeat': 'checked',
-                'checkbox_Enable_TCP_Bridge': 'checked',
-                'checkbox_Enable_custom_Bridge_port': '',
-                'checkbox_SDK_Password_Require': '',
-                'enable_odoo': 1,
-                'enable_tls': 0,
-                'modbus_id': 239,
-                'modbus_port': 502,
-                'modbus_uart_timeout': 1000,
-                'rbridge_started': 0
-            },
-            'uartConfig': [
-                {
-                    'br': 9600,
-                    'db': 3,
-                    'fc': 0,
-                    'ft': 122,
-                    'port': 0,
-                    'pr': 0,
-                    'rt': False,
-                    'sb': 1,
-                    'usage': 0
-                },
-                {
-                    'br': 9600,
-                    'db': 3,
-                    'fc': 0,
-                    'ft': 122,
-                    'port': 2,
-                    'pr': 0,
-                    'rt': False,
-                    'sb': 1,
-                    'usage': 1
-                }
-            ],
-            'wifiConfig': {
-                'apauth': 3,
-                'apbeac': 100,
-                'apchan': 11,
-                'aphidd': 0,
-                'apmac': '00:24:fe:3f:00:00',
-                'apmaxc': 4,
-                'apssid': 'WIFI-16C4',
-                'chan': 0,
-                'mode': 1,
-                'phy': 5,
-                'rssi': 0,
-                'ssid': 'PH',
-                'stamac': '24:0a:c4:16:04:c0',
-                'status': 1073610744
-            }
-        }
-        body = json.dumps(body)
-        self.send_response(200)
-        self.send_header('content-length', len(body))
-        self.end_headers()
-        self.wfile.write(body.encode())
-
-    def do_POST(self):
-        buff = self.rfile.read(int(self.headers['content-length'])).decode()
-        self._q.put(buff)
-        self.send_response(200)
-
-        if self.path == '/sdk/cmd.json':
-            js = json.loads(buff)
-            response = {
-                'convertor': 423152,
-                'response': {
-                    'id': js['cmd']['id'],
-                    'c': js['cmd']['c'],
-                    'e': 0,
-                    'd': '',
-                }
-            }
-            response = json.dumps(response).encode()
-            self.send_header('content-length', len(response))
-            self.end_headers()
-            self.wfile.write(response)
-        else:
-            self.end_headers()
-
-
-class HttpServerThread(Thread):
-    def __init__(self, server: HTTPServer):
-        super().__init__()
-        self._server = server
-
-    def run(self):
-        self._server.serve_forever()
+import socket
+import time
 
 
 class WebstackTests(common.SavepointCase):
@@ -195,16 +22,11 @@ class WebstackTests(common.SavepointCase):
         cls._ws = create_webstacks(cls.env, 1, [2])
 
     def run_test_webstack_server(self):
-        queue = Queue()
-        self._q = queue
-        custom_handler = partial(WebstackEmulationHandler, queue)
-        self._ws_server = HTTPServer(('', 80), custom_handler)
-        self._ws_server_thread = HttpServerThread(self._ws_server)
-        self._ws_server_thread.start()
+        self._q = Queue()
+        self._ws_server, self._ws_server_thread = start_emulator(self._q, port=80)
 
     def stop_test_webstack_server(self):
-        self._ws_server.shutdown()
-        self._ws_server_thread.join()
+        stop_emulator(self._ws_server, self._ws_server_thread)
         self._ws_server = None
         self._ws_server_thread = None
 
@@ -408,13 +230,7 @@ class ControllerTests(common.SavepointCase):
         ctrl.io_table = ctrl.get_default_io_table(ctrl.hw_version, ctrl.sw_version, ctrl.mode)
         wiz = self.env['hr.rfid.ctrl.io.table.wiz'].with_context(active_ids=ctrl.id).create({})
 
-        wiz_io_table = ''
-        for row in wiz.io_row_ids:
-            outs = [ row.out8, row.out7, row.out6, row.out5, row.out4, row.out3, row.out2, row.out1 ]
-            row_str = ''.join([ '%02X' % a for a in outs ])
-            wiz_io_table += row_str
-
-        self.assertEqual(ctrl.io_table, wiz_io_table)
+        self.assertEqual(ctrl.io_table, io_table_from_rows(wiz.io_row_ids))
 
         wiz.io_row_ids[0].out5 = 9 - wiz.io_row_ids[0].out5
         wiz.io_row_ids[1].out5 = 9 - wiz.io_row_ids[1].out5
@@ -423,11 +239,7 @@ class ControllerTests(common.SavepointCase):
         wiz.io_row_ids[4].out5 = 9 - wiz.io_row_ids[4].out5
         wiz.io_row_ids[5].out5 = 9 - wiz.io_row_ids[5].out5
 
-        new_io_table = ''
-        for row in wiz.io_row_ids:
-            outs = [ row.out8, row.out7, row.out6, row.out5, row.out4, row.out3, row.out2, row.out1 ]
-            row_str = ''.join([ '%02X' % a for a in outs ])
-            new_io_table += row_str
+        new_io_table = io_table_from_rows(wiz.io_row_ids)
 
         wiz.save_table()
         self.assertEqual(new_io_table, ctrl.io_table)
@@ -460,16 +272,11 @@ class DoorTests(common.SavepointCase):
         cls._acc_grs[1].add_doors(cls._doors[1], cls._def_ts)
 
     def run_test_webstack_server(self):
-        queue = Queue()
-        self._q = queue
-        custom_handler = partial(WebstackEmulationHandler, queue)
-        self._ws_server = HTTPServer(('', 80), custom_handler)
-        self._ws_server_thread = HttpServerThread(self._ws_server)
-        self._ws_server_thread.start()
+        self._q = Queue()
+        self._ws_server, self._ws_server_thread = start_emulator(self._q, port=80)
 
     def stop_test_webstack_server(self):
-        self._ws_server.shutdown()
-        self._ws_server_thread.join()
+        stop_emulator(self._ws_server, self._ws_server_thread)
         self._ws_server = None
         self._ws_server_thread = None
 
@@ -902,3 +709,243 @@ class CommandTests(common.SavepointCase):
 
     def test_write(self):
         pass  # TODO Implement
+
+
+class EventSinkHandler(BaseHTTPRequestHandler):
+    def __init__(self, queue: Queue, *args, status: int = 200, drop: bool = False, **kwargs):
+        """
+        :param status: Status returned for every push
+        :param drop: Close the connection in the middle of the response instead
+        """
+        self._q = queue
+        self._status = status
+        self._drop = drop
+        super().__init__(*args, **kwargs)
+
+    def do_POST(self):
+        buff = self.rfile.read(int(self.headers['content-length'])).decode()
+        self._q.put(json.loads(buff))
+        if self._drop:
+            self.wfile.write(b'HTTP/1.1 200 OK\r\ncontent-length: 100\r\n\r\n{')
+            self.close_connection = True
+            return
+        self.send_response(self._status)
+        self.send_header('content-length', 0)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebstackEmulationHandlerTests(common.SavepointCase):
+    _cmds = [
+        { 'id': 1, 'c': 'DB', 'd': '010105' },
+        { 'id': 2, 'c': 'D6', 'd': '' },
+    ]
+
+    def run_emulator(self, sdk_version: str):
+        self._ws_server, self._ws_server_thread = start_emulator(Queue(), host='localhost',
+                                                                 sdk_version=sdk_version)
+
+    def stop_emulator(self):
+        stop_emulator(self._ws_server, self._ws_server_thread)
+
+    def post_cmd(self, cmd):
+        conn = HTTPConnection('localhost', self._ws_server.server_address[1], timeout=5)
+        try:
+            conn.request('POST', '/sdk/cmd.json', json.dumps({ 'cmd': cmd }).encode())
+            response = conn.getresponse()
+            return response.status, response.read().decode()
+        finally:
+            conn.close()
+
+    def test_batching_webstack(self):
+        cmds = self._cmds
+        self.run_emulator(WebstackEmulationHandler.batch_sdk_version)
+        try:
+            status, body = self.post_cmd(cmds)
+            single_status, single_body = self.post_cmd(cmds[0])
+        finally:
+            self.stop_emulator()
+
+        self.assertEqual(status, 200)
+        js = json.loads(body)
+        self.assertIsInstance(js['response'], list)
+        self.assertEqual([ (r['id'], r['c'], r['e']) for r in js['response'] ],
+                         [ (c['id'], c['c'], 0) for c in cmds ])
+
+        self.assertEqual(single_status, 200)
+        js = json.loads(single_body)
+        self.assertIsInstance(js['response'], dict)
+        self.assertEqual((js['response']['id'], js['response']['c']), (1, 'DB'))
+
+    def test_non_batching_webstack(self):
+        cmds = self._cmds
+        self.run_emulator('1.46')
+        try:
+            status, __ = self.post_cmd(cmds)
+            single_status, single_body = self.post_cmd(cmds[0])
+        finally:
+            self.stop_emulator()
+
+        self.assertEqual(status, 400)
+
+        self.assertEqual(single_status, 200)
+        js = json.loads(single_body)
+        self.assertEqual((js['response']['id'], js['response']['c'], js['response']['e']), (1, 'DB', 0))
+
+
+class WebstackEmulatorTests(common.SavepointCase):
+    @classmethod
+    def setUpClass(cls):
+        super(WebstackEmulatorTests, cls).setUpClass()
+        cls._ws = create_webstacks(cls.env, 3, [1, 3])
+
+    def test_fleet(self):
+        virtual_wss = [ VirtualWebstack.from_record(ws, sdk_version='1.47') for ws in self._ws ]
+        fleet = WebstackEmulatorFleet(virtual_wss, host='localhost')
+        fleet.start()
+
+        # A client that connects and never sends anything must not block the other devices
+        stalled = socket.create_connection(('localhost', virtual_wss[0].port))
+
+        try:
+            ports = set()
+            for ws, virtual_ws in zip(self._ws, virtual_wss):
+                self.assertEqual(virtual_ws.serial, int(ws.serial))
+                self.assertCountEqual(virtual_ws.controllers, [ (c.ctrl_id, c.mode) for c in ws.controllers ])
+                self.assertNotEqual(virtual_ws.port, 0)
+                ports.add(virtual_ws.port)
+
+                conn = HTTPConnection('localhost', virtual_ws.port, timeout=5)
+                conn.request('GET', '/sdk/status.json')
+                js = json.loads(conn.getresponse().read().decode())
+                conn.close()
+                self.assertEqual(js['convertor'], virtual_ws.serial)
+                self.assertEqual(js['sdk']['sdkVersion'], '1.47')
+
+                cmds = [
+                    { 'id': ws.controllers[0].ctrl_id, 'c': 'DB', 'd': '010105' },
+                    { 'id': ws.controllers[1].ctrl_id, 'c': 'D6', 'd': '' },
+                ]
+                conn = HTTPConnection('localhost', virtual_ws.port, timeout=5)
+                conn.request('POST', '/sdk/cmd.json', json.dumps({ 'cmd': cmds }).encode())
+                js = json.loads(conn.getresponse().read().decode())
+                conn.close()
+                self.assertEqual(js['convertor'], virtual_ws.serial)
+                self.assertIsInstance(js['response'], list)
+                self.assertEqual([ (r['id'], r['c'], r['e']) for r in js['response'] ],
+                                 [ (c['id'], c['c'], 0) for c in cmds ])
+                self.assertEqual(virtual_ws.queue.qsize(), 1)
+        finally:
+            stalled.close()
+            fleet.stop()
+
+        self.assertEqual(len(ports), len(virtual_wss))
+        # The stalled connection is accepted and dropped after the handler timeout
+        self.assertEqual(fleet.stats['requests_served'], 2 * len(virtual_wss) + 1)
+
+    _push_cards = [ '0000000001', '0000000002' ]
+    _pushers = 4
+
+    def start_push_fleet(self, **sink_kwargs):
+        """
+        Start an event sink and a fleet pushing heartbeats and events to it
+        :param sink_kwargs: Passed to EventSinkHandler
+        :return: (fleet, sink queue, sink server, sink thread)
+        """
+        sink_queue = Queue()
+        sink, sink_thread = start_server(partial(EventSinkHandler, sink_queue, **sink_kwargs), host='localhost')
+
+        virtual_wss = [ VirtualWebstack.from_record(ws, cards=self._push_cards) for ws in self._ws ]
+        event_url = 'http://localhost:%d/hr/rfid/event' % sink.server_address[1]
+        fleet = WebstackEmulatorFleet(virtual_wss, host='localhost', event_url=event_url,
+                                      heartbeat_rate=5, event_rate=5, pushers=self._pushers)
+        fleet.start()
+        return fleet, sink_queue, sink, sink_thread
+
+    def test_fleet_push(self):
+        cards = self._push_cards
+        fleet, sink_queue, sink, sink_thread = self.start_push_fleet()
+        virtual_wss = fleet.webstacks
+
+        bodies = []
+        try:
+            # Every device pushes a heartbeat and an event right away, give them a few seconds
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                pushed = { (b['convertor'], 'heartbeat' in b) for b in list(sink_queue.queue) }
+                if len(pushed) == 2 * len(virtual_wss):
+                    break
+                time.sleep(0.1)
+        finally:
+            fleet.stop()
+            stop_emulator(sink, sink_thread)
+
+        while not sink_queue.empty():
+            bodies.append(sink_queue.get())
+
+        self.assertEqual(fleet.stats['push_errors'], 0)
+        self.assertEqual(fleet.stats['pushed'], len(bodies))
+
+        heartbeats = [ b for b in bodies if 'heartbeat' in b ]
+        events = [ b for b in bodies if 'event' in b ]
+        self.assertEqual(len(heartbeats) + len(events), len(bodies))
+
+        for virtual_ws in virtual_wss:
+            ws_heartbeats = [ b for b in heartbeats if b['convertor'] == virtual_ws.serial ]
+            ws_events = [ b for b in events if b['convertor'] == virtual_ws.serial ]
+            self.assertTrue(ws_heartbeats)
+            self.assertTrue(ws_events)
+
+            for body in ws_heartbeats:
+                self.assertEqual(set(body), { 'convertor', 'key', 'heartbeat' })
+                self.assertEqual(body['key'], virtual_ws.key)
+            # Pushers run in parallel, heartbeats may arrive out of order but none may be missing
+            self.assertEqual(sorted(b['heartbeat'] for b in ws_heartbeats),
+                             list(range(1, len(ws_heartbeats) + 1)))
+
+            ctrl_ids = [ ctrl_id for ctrl_id, __ in virtual_ws.controllers ]
+            for body in ws_events:
+                self.assertEqual(set(body), { 'convertor', 'key', 'event' })
+                self.assertEqual(body['key'], virtual_ws.key)
+                event = body['event']
+                self.assertIn(event['id'], ctrl_ids)
+                self.assertIn(event['card'], cards)
+                self.assertIn(event['reader'], [ 1, 2, 3, 4 ])
+                try:
+                    datetime.datetime.strptime(event['date'] + ' ' + event['time'], '%m.%d.%y %H:%M:%S')
+                except ValueError:
+                    self.fail('Event date and time are not in the webstack format')
+
+    def assertPushFails(self, **sink_kwargs):
+        """
+        Every push to a sink created with sink_kwargs fails. The failures are counted and the
+        pushers keep going
+        """
+        fleet, sink_queue, sink, sink_thread = self.start_push_fleet(**sink_kwargs)
+        try:
+            deadline = time.monotonic() + 10
+            while fleet.stats['push_errors'] < 5 and time.monotonic() < deadline:
+                time.sleep(0.1)
+            errors = fleet.stats['push_errors']
+            self.assertGreater(errors, 0)
+
+            deadline = time.monotonic() + 10
+            while fleet.stats['push_errors'] <= errors and time.monotonic() < deadline:
+                time.sleep(0.1)
+            self.assertGreater(fleet.stats['push_errors'], errors)
+            self.assertEqual(fleet.alive_pushers(), self._pushers)
+        finally:
+            fleet.stop()
+            stop_emulator(sink, sink_thread)
+
+        self.assertEqual(fleet.stats['pushed'], 0)
+        # The sink did receive the bodies, only the responses were bad
+        self.assertFalse(sink_queue.empty())
+
+    def test_fleet_push_connection_dropped(self):
+        self.assertPushFails(drop=True)
+
+    def test_fleet_push_server_error(self):
+        self.assertPushFails(status=500)
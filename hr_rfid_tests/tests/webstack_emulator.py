@@ -0,0 +1,540 @@
+"""
+Emulation of Polimex webstacks for the hr_rfid tests.
+
+WebstackEmulationHandler + HttpServerThread emulate a single device. WebstackEmulatorFleet runs
+any number of VirtualWebstack devices, each on its own port, from one selector loop in a single
+thread, and can make every device push heartbeats and card events to the Odoo event endpoint.
+
+The module does not depend on Odoo, so a fleet can also be started against a running server:
+
+    python3 webstack_emulator.py --webstacks 500 --event-url http://localhost:8069/hr/rfid/event \\
+        --heartbeat-rate 0.1 --event-rate 1 --duration 60
+"""
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.client import HTTPConnection, HTTPException
+from threading import Thread, Event, Lock
+from queue import Queue, Empty
+from functools import partial
+from random import randint, choice
+from urllib.parse import urlsplit
+
+import argparse
+import datetime
+import json
+import selectors
+import time
+
+
+class WebstackEmulationHandler(BaseHTTPRequestHandler):
+    # Lowest sdkVersion that accepts a list of commands in a single /sdk/cmd.json request
+    batch_sdk_version = '1.47'
+
+    def __init__(self, queue: Queue, *args, sdk_version: str = '1.46', serial: int = None, **kwargs):
+        """
+        :param queue: Every POST body the emulated webstack receives is put here
+        :param sdk_version: Version reported in 'sdkVersion'. From batch_sdk_version on the webstack
+                            accepts a list of commands in a single /sdk/cmd.json request, older
+                            versions answer such a request with 400 Bad Request
+        :param serial: Serial reported in 'convertor'. If not set the fixed serials of the
+                       original single-device emulator are reported
+        """
+        self._q = queue
+        self._sdk_version = sdk_version
+        self._serial = serial
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        body = {
+            'bridgeClient': {
+                'add_info': 0,
+                'auto_connect': 0,
+                'last_error': 0,
+                'port': 5000,
+                'status': 0,
+                'url': 'url.or.ip.com'
+            },
+            'convertor': self._serial if self._serial is not None else 404040,
+            'currentIPFiltering': {
+                'IP1': '0.0.0.0',
+                'checkbox_Enable_IP1_filter': ''
+            },
+            'inputOutputHardware': {
+                'portInDigital': 5,
+                'portOut': 4,
+                'uarts': [
+                    [
+                        0,
+                        [
+                            0,
+                            2,
+                            5
+                        ]
+                    ],
+                    [
+                        2,
+                        [
+                            0,
+                            1,
+                            2,
+                            5
+                        ]
+                    ]
+                ]
+            },
+            'netConfig': {
+                'Gateway': '192.168.74.254',
+                'Host_Name': 'WIFI-16C4',
+                'IP_Address': '192.168.74.61',
+                'MAC_Address': '24:0a:c4:16:04:c3',
+                'Primary_DNS': '192.168.74.254',
+                'Secondary_DNS': '0.0.0.0',
+                'Subnet_Mask': '255.255.255.0',
+                'checkbox_DHCP': 'checked',
+                'net_mode': 1,
+                'sntp_server': 'bg.pool.ntp.org'
+            },
+            'sdk': {
+                'ConnectionType': 3,
+                'TCPStackVersion': 'v3.3-71-g46b12a5',
+                'devFound': 1,
+                'deviceTime': 1571388442,
+                'freeRAM': 69716,
+                'heartBeatCounter': 2375,
+                'heartBeatTimeOut': 11,
+                'isBridgeActive': 0,
+                'isCmdExecute': 0,
+                'isCmdWaiting': 0,
+                'isDeviceScan': 0,
+                'isEventPause': 0,
+                'isEventScan': 1,
+                'isServerToSendDown': 0,
+                'maxDevInList': 64,
+                'remoteIP': '0.0.0.0',
+                'scanIDfrom': 0,
+                'scanIDprogress': 0,
+                'scanIDto': 254,
+                'sdkHardware': '100.1',
+                'sdkVersion': self._sdk_version,
+                'upTime': '1d 15:51:08'
+            },
+            'sdkSettings': {
+                'Bridge_PORT': 5000,
+                'HeartBeat_Time': 60,
+                'Server_PORT': '8069',
+                'Server_URL': 'ilian.com/hr/rfid/event',
+                'checkbox_Enable_HTTP_IO_Event_Server_Push': '',
+                'checkbox_Enable_HTTP_Pull_Technology': 'checked',
+                'checkbox_Enable_HTTP_Server_Push': 'checked',
+                'checkbox_Enable_HeartBeat': 'checked',
+                'checkbox_Enable_TCP_Bridge': 'checked',
+                'checkbox_Enable_custom_Bridge_port': '',
+                'checkbox_SDK_Password_Require': '',
+                'enable_odoo': 1,
+                'enable_tls': 0,
+                'modbus_id': 239,
+                'modbus_port': 502,
+                'modbus_uart_timeout': 1000,
+                'rbridge_started': 0
+            },
+            'uartConfig': [
+                {
+                    'br': 9600,
+                    'db': 3,
+                    'fc': 0,
+                    'ft': 122,
+                    'port': 0,
+                    'pr': 0,
+                    'rt': False,
+                    'sb': 1,
+                    'usage': 0
+                },
+                {
+                    'br': 9600,
+                    'db': 3,
+                    'fc': 0,
+                    'ft': 122,
+                    'port': 2,
+                    'pr': 0,
+                    'rt': False,
+                    'sb': 1,
+                    'usage': 1
+                }
+            ],
+            'wifiConfig': {
+                'apauth': 3,
+                'apbeac': 100,
+                'apchan': 11,
+                'aphidd': 0,
+                'apmac': '00:24:fe:3f:00:00',
+                'apmaxc': 4,
+                'apssid': 'WIFI-16C4',
+                'chan': 0,
+                'mode': 1,
+                'phy': 5,
+                'rssi': 0,
+                'ssid': 'PH',
+                'stamac': '24:0a:c4:16:04:c0',
+                'status': 1073610744
+            }
+        }
+        body = json.dumps(body)
+        self.send_response(200)
+        self.send_header('content-length', len(body))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def supports_batching(self):
+        def _version(version: str):
+            return tuple(int(a) for a in version.split('.'))
+        return _version(self._sdk_version) >= _version(self.batch_sdk_version)
+
+    def do_POST(self):
+        buff = self.rfile.read(int(self.headers['content-length'])).decode()
+        self._q.put(buff)
+
+        if self.path == '/sdk/cmd.json':
+            js = json.loads(buff)
+
+            # A batched frame carries a list of commands and gets one response per command.
+            # Older firmware can't parse it
+            if isinstance(js['cmd'], list) and not self.supports_batching():
+                self.send_response(400)
+                self.send_header('content-length', 0)
+                self.end_headers()
+                return
+
+            def _cmd_response(cmd):
+                return {
+                    'id': cmd['id'],
+                    'c': cmd['c'],
+                    'e': 0,
+                    'd': '',
+                }
+
+            if isinstance(js['cmd'], list):
+                cmd_response = [ _cmd_response(cmd) for cmd in js['cmd'] ]
+            else:
+                cmd_response = _cmd_response(js['cmd'])
+
+            response = {
+                'convertor': self._serial if self._serial is not None else 423152,
+                'response': cmd_response,
+            }
+            response = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('content-length', len(response))
+            self.end_headers()
+            self.wfile.write(response)
+        else:
+            self.send_response(200)
+            self.end_headers()
+
+
+class HttpServerThread(Thread):
+    def __init__(self, server: HTTPServer):
+        super().__init__()
+        self._server = server
+
+    def run(self):
+        self._server.serve_forever()
+
+
+def start_server(handler, port: int = 0, host: str = ''):
+    """
+    Serve handler from its own thread
+    :param port: Port to listen on. With 0 a free port is picked, read it from server.server_address[1]
+    :return: (server, thread), pass them to stop_emulator
+    """
+    server = HTTPServer((host, port), handler)
+    thread = HttpServerThread(server)
+    thread.start()
+    return server, thread
+
+
+def start_emulator(queue: Queue, port: int = 0, sdk_version: str = '1.46', host: str = ''):
+    """
+    Start a single emulated webstack
+    :param queue: Every POST body the webstack receives is put here
+    :return: (server, thread), pass them to stop_emulator
+    """
+    return start_server(partial(WebstackEmulationHandler, queue, sdk_version=sdk_version), port, host)
+
+
+def stop_emulator(server: HTTPServer, thread: Thread):
+    """
+    Stop a server started with start_emulator or start_server and release its port
+    """
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+class _QuietWebstackEmulationHandler(WebstackEmulationHandler):
+    # Headers and body are written separately, don't let Nagle hold back the body
+    disable_nagle_algorithm = True
+    # Requests are handled in the fleet's loop thread, a client that connects and stalls may only
+    # hold up the other devices and the push scheduling for this long
+    timeout = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class VirtualWebstack(object):
+    # Number of readers for each controller mode
+    _mode_readers = { 1: 2, 2: 2, 3: 4, 4: 4 }
+
+    def __init__(self, serial: int, port: int = 0, controllers: list = None, key: str = '0000',
+                 sdk_version: str = '1.46', cards: list = None):
+        """
+        A single device of a WebstackEmulatorFleet
+        :param serial: Serial of the webstack, reported as 'convertor'
+        :param port: Port to listen on. With 0 a free port is picked when the fleet starts
+        :param controllers: A list of (ctrl_id, mode) tuples for the controllers behind the webstack
+        :param key: Key sent with every pushed heartbeat and event
+        :param sdk_version: Version reported in 'sdkVersion'
+        :param cards: Card numbers used for the pushed card events
+        """
+        self.serial = serial
+        self.port = port
+        self.controllers = controllers if controllers is not None else []
+        self.key = key
+        self.sdk_version = sdk_version
+        self.cards = cards if cards is not None else []
+        self.queue = Queue()
+        self.server = None
+        self.heartbeat_counter = 0
+        self.event_counter = 0
+
+    @classmethod
+    def from_record(cls, webstack, port: int = 0, sdk_version: str = '1.46', cards: list = None):
+        """
+        Create a virtual webstack mirroring an hr.rfid.webstack record and its controllers
+        """
+        controllers = [ (ctrl.ctrl_id, ctrl.mode) for ctrl in webstack.controllers ]
+        return cls(int(webstack.serial), port, controllers, webstack.key, sdk_version, cards)
+
+    def heartbeat_body(self):
+        self.heartbeat_counter += 1
+        return {
+            'convertor': self.serial,
+            'key': self.key,
+            'heartbeat': self.heartbeat_counter,
+        }
+
+    def event_body(self):
+        """
+        A card event the way the webstack pushes it: date and time together parse
+        with '%m.%d.%y %H:%M:%S'
+        """
+        self.event_counter += 1
+        ctrl_id, mode = choice(self.controllers)
+        now = datetime.datetime.now()
+        return {
+            'convertor': self.serial,
+            'key': self.key,
+            'event': {
+                'bos': 1,
+                'tos': 1,
+                'card': choice(self.cards) if self.cards else '%010d' % randint(1, 9999999999),
+                'date': now.strftime('%m.%d.%y'),
+                'time': now.strftime('%H:%M:%S'),
+                'day': now.isoweekday() % 7,
+                'dt': '0000',
+                'err': 0,
+                'event_n': 3,
+                'id': ctrl_id,
+                'reader': randint(1, self._mode_readers.get(int(mode) & 0x0F, 1)),
+            },
+        }
+
+
+class WebstackEmulatorFleet(Thread):
+    def __init__(self, webstacks: list, host: str = '', event_url: str = None, heartbeat_rate: float = 0,
+                 event_rate: float = 0, pushers: int = 4, poll_interval: float = 0.05):
+        """
+        Runs many virtual webstacks from a single selector loop
+        :param webstacks: List of VirtualWebstack
+        :param host: Address the device servers are bound to
+        :param event_url: Full url of the Odoo event endpoint, e.g. http://localhost:8069/hr/rfid/event.
+                          Nothing is pushed if it's not set
+        :param heartbeat_rate: Heartbeats per second pushed by every device
+        :param event_rate: Card events per second pushed by every device. Devices without
+                           controllers don't push card events
+        :param pushers: Number of threads posting to event_url, each holding a keep-alive connection
+        :param poll_interval: Max time the loop waits for device requests before checking for due pushes
+        """
+        super().__init__(daemon=True)
+        self.webstacks = webstacks
+        self._host = host
+        self._event_url = urlsplit(event_url) if event_url else None
+        self._heartbeat_period = 1 / heartbeat_rate if heartbeat_rate > 0 else None
+        self._event_period = 1 / event_rate if event_rate > 0 else None
+        self._pushers_count = pushers
+        self._poll_interval = poll_interval
+        self._stop_event = Event()
+        self._push_queue = Queue()
+        self._pushers = []
+        self._stats_lock = Lock()
+        self.stats = {
+            'requests_served': 0,
+            'pushed': 0,
+            'push_errors': 0,
+            'push_time': 0.0,
+        }
+
+    def start(self):
+        """
+        Bind all device servers and start serving. Ports of devices created with port 0
+        are updated with the port picked by the system
+        """
+        for ws in self.webstacks:
+            handler = partial(_QuietWebstackEmulationHandler, ws.queue, sdk_version=ws.sdk_version,
+                              serial=ws.serial)
+            ws.server = HTTPServer((self._host, ws.port), handler)
+            ws.port = ws.server.server_address[1]
+
+        if self._event_url is not None:
+            for __ in range(self._pushers_count):
+                pusher = Thread(target=self._push_loop, daemon=True)
+                pusher.start()
+                self._pushers.append(pusher)
+
+        super().start()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        for pusher in self._pushers:
+            pusher.join()
+        self._pushers = []
+        for ws in self.webstacks:
+            ws.server.server_close()
+            ws.server = None
+
+    def alive_pushers(self):
+        """
+        :return: Number of pusher threads still running
+        """
+        return len([ a for a in self._pushers if a.is_alive() ])
+
+    def run(self):
+        now = time.monotonic()
+        next_heartbeat = { ws.serial: now for ws in self.webstacks }
+        next_event = { ws.serial: now for ws in self.webstacks if ws.controllers }
+
+        with selectors.DefaultSelector() as selector:
+            for ws in self.webstacks:
+                selector.register(ws.server, selectors.EVENT_READ)
+
+            while not self._stop_event.is_set():
+                for key, __ in selector.select(self._poll_interval):
+                    key.fileobj._handle_request_noblock()
+                    self.stats['requests_served'] += 1
+
+                if self._event_url is None:
+                    continue
+
+                now = time.monotonic()
+                for ws in self.webstacks:
+                    if self._heartbeat_period is not None and next_heartbeat[ws.serial] <= now:
+                        next_heartbeat[ws.serial] += self._heartbeat_period
+                        self._push_queue.put(ws.heartbeat_body())
+                    if self._event_period is not None and ws.serial in next_event \
+                            and next_event[ws.serial] <= now:
+                        next_event[ws.serial] += self._event_period
+                        self._push_queue.put(ws.event_body())
+
+    def _push_loop(self):
+        url = self._event_url
+        conn = HTTPConnection(url.hostname, url.port or 80, timeout=10)
+        headers = { 'Content-Type': 'application/json' }
+
+        while not self._stop_event.is_set():
+            try:
+                body = self._push_queue.get(timeout=self._poll_interval)
+            except Empty:
+                continue
+
+            start = time.monotonic()
+            try:
+                # Sent as bytes so http.client writes headers and body in one segment
+                conn.request('POST', url.path, json.dumps(body).encode(), headers)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, ValueError, HTTPException):
+                conn.close()
+                ok = False
+
+            with self._stats_lock:
+                self.stats['push_time'] += time.monotonic() - start
+                if ok:
+                    self.stats['pushed'] += 1
+                else:
+                    self.stats['push_errors'] += 1
+
+        conn.close()
+
+
+def create_fleet(webstacks: int, controllers: list = None, cards: int = 0, first_serial: int = 400000,
+                 base_port: int = 0, **kwargs):
+    """
+    Creates a fleet of identical virtual webstacks
+    :param webstacks: Number of webstacks
+    :param controllers: A list of modes the controllers should be for every webstack, same as in
+                        common.create_webstacks
+    :param cards: Number of card numbers the webstacks pick from when pushing card events
+    :param first_serial: Serial of the first webstack, the rest are numbered sequentially
+    :param base_port: Port of the first webstack, the rest use the next ports. With 0 every
+                      webstack gets a free port
+    :param kwargs: Passed to WebstackEmulatorFleet
+    :return: WebstackEmulatorFleet, not started
+    """
+    if controllers is None:
+        controllers = []
+    card_numbers = [ '%010d' % (i + 1) for i in range(cards) ]
+
+    devices = []
+    for i in range(webstacks):
+        port = base_port + i if base_port else 0
+        ctrls = [ (ctrl_id + 1, mode) for ctrl_id, mode in enumerate(controllers) ]
+        devices.append(VirtualWebstack(first_serial + i, port, ctrls, cards=card_numbers))
+
+    return WebstackEmulatorFleet(devices, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fleet of emulated webstacks')
+    parser.add_argument('--webstacks', type=int, default=1)
+    parser.add_argument('--controllers', type=int, nargs='*', default=[3, 3, 3, 3],
+                        help='Modes of the controllers of every webstack')
+    parser.add_argument('--cards', type=int, default=1000)
+    parser.add_argument('--first-serial', type=int, default=400000)
+    parser.add_argument('--base-port', type=int, default=0)
+    parser.add_argument('--event-url', default=None)
+    parser.add_argument('--heartbeat-rate', type=float, default=0)
+    parser.add_argument('--event-rate', type=float, default=0)
+    parser.add_argument('--pushers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=60)
+    args = parser.parse_args()
+
+    fleet = create_fleet(args.webstacks, args.controllers, args.cards, args.first_serial, args.base_port,
+                         event_url=args.event_url, heartbeat_rate=args.heartbeat_rate,
+                         event_rate=args.event_rate, pushers=args.pushers)
+    fleet.start()
+    try:
+        time.sleep(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fleet.stop()
+
+    stats = dict(fleet.stats)
+    stats['pushed_per_second'] = stats['pushed'] / args.duration
+    stats['avg_push_time'] = stats['push_time'] / stats['pushed'] if stats['pushed'] else 0
+    print(json.dumps(stats, indent=4))
+
+
+if __name__ == '__main__':
+    main()